@@ -1,28 +1,54 @@
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from jose import jwt, JWTError
-import os
+from functools import lru_cache
+import jwt
+import time
+
+from app.core.security import JWT_SECRET, JWT_ALG
 
 bearer = HTTPBearer()
 
-JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
-JWT_ALG = "HS256"
+# decoded tokens: {token: (user, exp_s)}; tokens are immutable until exp,
+# so drivers pinging at 1Hz only pay for jwt.decode once
+_TOKEN_CACHE_MAX = 10000
+_token_cache: dict[str, tuple[dict, int]] = {}
 
-def get_current_user(creds: HTTPAuthorizationCredentials = Depends(bearer)):
+async def get_current_user(creds: HTTPAuthorizationCredentials = Depends(bearer)):
     token = creds.credentials
+
+    hit = _token_cache.get(token)
+    if hit is not None:
+        user, exp = hit
+        if exp > time.time():
+            return user
+        _token_cache.pop(token, None)
+
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
         sub = payload.get("sub")
         role = payload.get("role")
         if not sub or not role:
             raise HTTPException(status_code=401, detail="Invalid token")
-        return {"sub": sub, "role": role}
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def require_roles(*allowed):
-    def _guard(user=Depends(get_current_user)):
+    user = {"sub": sub, "role": role}
+    exp = payload.get("exp")
+    if exp:
+        if len(_token_cache) >= _TOKEN_CACHE_MAX:
+            # drop the oldest entry (dicts keep insertion order)
+            _token_cache.pop(next(iter(_token_cache)))
+        _token_cache[token] = (user, exp)
+    return user
+
+@lru_cache
+def _make_guard(allowed: frozenset):
+    async def _guard(user=Depends(get_current_user)):
         if user["role"] not in allowed:
             raise HTTPException(status_code=403, detail="Forbidden")
         return user
     return _guard
+
+def require_roles(*allowed):
+    # one shared guard per role set, e.g. every require_roles("owner") is the same callable
+    return _make_guard(frozenset(allowed))
@@ -1,13 +1,83 @@
 import os, certifi
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+log = logging.getLogger(__name__)
+
+NAMESPACE_EXISTS = 48
+
+# share docs written since expires_at/TTL were introduced
+LIVE_SHARE = {"expires_at": {"$exists": True}}
+
+# resolved once at import instead of on client construction
+_CA_FILE = certifi.where()
 
 _client = None
+_db = None
 
 def db():
-    global _client
-    if _client is None:
+    global _client, _db
+    if _db is None:
         url = os.getenv("MONGO_URL")
         if not url:
             raise RuntimeError("MONGO_URL not set")
-        _client = AsyncIOMotorClient(url, tlsCAFile=certifi.where())
-    return _client["windsorlogistics"]
+        _client = AsyncIOMotorClient(
+            url,
+            tlsCAFile=_CA_FILE,
+            # keep warm sockets for bursts of location pings
+            maxPoolSize=200,
+            minPoolSize=20,
+            maxIdleTimeMS=60000,
+            # zstd if the server supports it, zlib (stdlib) otherwise
+            compressors="zstd,zlib",
+            retryWrites=True,
+            w="majority",
+            serverSelectionTimeoutMS=3000,
+        )
+        _db = _client["windsorlogistics"]
+    return _db
+
+
+async def ensure_collections():
+    database = db()
+
+    # location history is append-only telemetry -> time-series buckets
+    try:
+        await database.create_collection(
+            "locations",
+            timeseries={"timeField": "ts", "metaField": "trip_id", "granularity": "seconds"},
+        )
+    except (CollectionInvalid, OperationFailure) as e:
+        # another worker (or an earlier run) created it first
+        if isinstance(e, OperationFailure) and e.code != NAMESPACE_EXISTS:
+            raise
+
+    # a pre-existing regular collection can't be converted in place; it keeps
+    # working, but old docs have int-ms ts and new ones a BSON date
+    info = await database.list_collections(filter={"name": "locations"}).to_list(length=1)
+    if info and info[0].get("type") != "timeseries":
+        log.warning(
+            "'locations' is a regular collection, not time-series; "
+            "migrate it manually to get bucketed storage (ts is now a BSON date)"
+        )
+
+
+async def ensure_indexes():
+    database = db()
+    await database.trips.create_index([("trip_id", 1)], unique=True)
+    await database.trip_shares.create_index([("trip_id", 1)], unique=True)
+    # pre-index share docs had random, possibly clashing codes and no expires_at
+    # (so the TTL never removes them); scope otp uniqueness to current docs only
+    await database.trip_shares.create_index(
+        [("otp", 1)], unique=True, name="otp_unique_live", partialFilterExpression=LIVE_SHARE
+    )
+    # covers resolve-otp (otp -> trip_id, expires_ms) so it never fetches the doc
+    await database.trip_shares.create_index(
+        [("otp", 1), ("trip_id", 1), ("expires_ms", 1)],
+        name="cov_otp_trip_expires_live",
+        partialFilterExpression=LIVE_SHARE,
+    )
+    # TTL needs a BSON date; expires_ms is kept for the API response/check
+    await database.trip_shares.create_index([("expires_at", 1)], expireAfterSeconds=0)
+    await database.locations.create_index([("trip_id", 1), ("ts", -1)])
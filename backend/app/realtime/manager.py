@@ -1,25 +1,200 @@
-from typing import Dict, Set
+import asyncio
+import logging
+import os
+import orjson
+import struct
+import time
+import redis.asyncio as aioredis
+from typing import Dict, Optional, Tuple
 from fastapi import WebSocket
 
+log = logging.getLogger(__name__)
+
+# With REDIS_URL set, broadcasts go through a Redis stream per trip so every
+# uvicorn worker can reach its own sockets; without it, fan-out stays in-process.
+REDIS_URL = os.getenv("REDIS_URL")
+STREAM_MAXLEN = 1000
+# a trip stream with no new frames for this long is deleted by Redis
+STREAM_TTL_S = 3600
+
+# binary location frame (37 bytes vs ~120 as JSON), little-endian:
+# lat f64, lng f64, speed f64 (NaN = none), ts u64 ms, delay_min i32, color u8 (255 = none)
+LOCATION_FRAME = struct.Struct("<dddQiB")
+NO_COLOR = 255
+I32_MIN, I32_MAX = -(2 ** 31), 2 ** 31 - 1
+
+# frames buffered per subscriber; a slow client loses its oldest frames, not memory
+CLIENT_QUEUE_MAX = 32
+
+
+def _stream(trip_id: str) -> str:
+    return f"trip:{trip_id}"
+
+
+def _id_key(entry_id: bytes | str) -> tuple[int, int]:
+    # stream ids are "<ms>-<seq>"; compare numerically, not as strings
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
 class WSManager:
     def __init__(self):
-        self.rooms: Dict[str, Set[WebSocket]] = {}
+        # trip_id -> {ws: its outbound queue}; one writer task per ws drains the queue
+        self.rooms: Dict[str, Dict[WebSocket, asyncio.Queue]] = {}
+        self._writers: Dict[WebSocket, asyncio.Task] = {}
+        # read-only copy of each room's queues for broadcast; rebuilt on connect/disconnect
+        self.snapshots: Dict[str, Tuple[asyncio.Queue, ...]] = {}
+
+        self.redis = None
+        # trip_id -> last stream id this worker delivered (only trips with local sockets)
+        self._offsets: Dict[str, bytes | str] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not REDIS_URL or self.redis is not None:
+            return
+        self.redis = aioredis.from_url(REDIS_URL)
+        self._reader = asyncio.create_task(self._read_streams())
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
 
     async def connect(self, trip_id: str, ws: WebSocket):
         await ws.accept()
-        self.rooms.setdefault(trip_id, set()).add(ws)
+        if self.redis is not None and trip_id not in self._offsets:
+            # start reading after the newest entry, so we only get new frames
+            try:
+                last = await self.redis.xrevrange(_stream(trip_id), count=1)
+                self._offsets[trip_id] = last[0][0] if last else "0-0"
+            except Exception:
+                # don't drop an accepted socket over it; "now" as a concrete id
+                # ("$" can't be compared to advance the offset) skips the backlog
+                log.exception("xrevrange failed for trip %s", trip_id)
+                self._offsets[trip_id] = f"{time.time_ns() // 1_000_000}-0"
+
+        q: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_MAX)
+        room = self.rooms.setdefault(trip_id, {})
+        room[ws] = q
+        self._writers[ws] = asyncio.create_task(self._write(trip_id, ws, q))
+        self.snapshots[trip_id] = tuple(room.values())
 
     def disconnect(self, trip_id: str, ws: WebSocket):
+        writer = self._writers.pop(ws, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
         if trip_id in self.rooms:
-            self.rooms[trip_id].discard(ws)
+            self.rooms[trip_id].pop(ws, None)
             if not self.rooms[trip_id]:
                 self.rooms.pop(trip_id, None)
+                self.snapshots.pop(trip_id, None)
+                self._offsets.pop(trip_id, None)
+            else:
+                self.snapshots[trip_id] = tuple(self.rooms[trip_id].values())
 
     async def broadcast(self, trip_id: str, message: dict):
-        for ws in list(self.rooms.get(trip_id, set())):
+        await self._publish(trip_id, orjson.dumps(message), binary=False)
+
+    async def broadcast_location(
+        self,
+        trip_id: str,
+        lat: float,
+        lng: float,
+        speed: float | None,
+        ts: int,
+        delay_min: int | None,
+        color_idx: int | None,
+    ):
+        data = LOCATION_FRAME.pack(
+            lat,
+            lng,
+            float("nan") if speed is None else speed,
+            ts,
+            # stored ETAs aren't bounded by the schemas, so keep delay inside i32
+            min(max(delay_min or 0, I32_MIN), I32_MAX),
+            NO_COLOR if color_idx is None else color_idx,
+        )
+        await self._publish(trip_id, data, binary=True)
+
+    async def _publish(self, trip_id: str, data: bytes, binary: bool):
+        if self.redis is not None:
+            key = _stream(trip_id)
+            # one round-trip; the EXPIRE is refreshed per frame, so only idle trips go away
             try:
-                await ws.send_json(message)
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.xadd(key, {"data": data, "bin": int(binary)}, maxlen=STREAM_MAXLEN, approximate=True)
+                    pipe.expire(key, STREAM_TTL_S)
+                    await pipe.execute()
             except Exception:
-                self.disconnect(trip_id, ws)
+                # live updates are best-effort; never fail the ping that triggered them
+                log.exception("publish to %s failed", key)
+            return
+        await self._send_local(trip_id, data, binary)
+
+    async def _send_local(self, trip_id: str, data: bytes, binary: bool):
+        queues = self.snapshots.get(trip_id, ())
+        if not queues:
+            return
+
+        # encoded once, queued for every subscriber; never waits on a socket
+        frame = (True, data) if binary else (False, data.decode())
+        for q in queues:
+            if q.full():
+                q.get_nowait()  # drop-oldest: live tracking only needs the latest
+            q.put_nowait(frame)
+
+    async def _write(self, trip_id: str, ws: WebSocket, q: asyncio.Queue):
+        try:
+            while True:
+                binary, payload = await q.get()
+                if binary:
+                    await ws.send_bytes(payload)
+                else:
+                    await ws.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(trip_id, ws)
+
+    async def _read_streams(self):
+        # plain XREAD, not a consumer group: every worker needs every frame
+        while True:
+            if not self._offsets:
+                await asyncio.sleep(0.5)
+                continue
+
+            streams = {_stream(t): off for t, off in self._offsets.items()}
+            try:
+                # short block so trips that connect meanwhile join the next read
+                resp = await self.redis.xread(streams, block=1000)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("xread failed, retrying in 1s")
+                await asyncio.sleep(1)
+                continue
+
+            for key, entries in resp or ():
+                trip_id = key.decode().split(":", 1)[1]
+                for entry_id, fields in entries:
+                    if trip_id not in self._offsets:
+                        break
+                    current = self._offsets[trip_id]
+                    if _id_key(entry_id) <= _id_key(current):
+                        # connect() reset the offset during xread; don't replay older frames
+                        continue
+                    self._offsets[trip_id] = entry_id
+                    await self._send_local(trip_id, fields[b"data"], fields.get(b"bin") == b"1")
 
 manager = WSManager()
@@ -1,74 +1,148 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from app.auth.deps import require_roles
 from app.db.mongo import db
 from app.realtime.manager import manager
 from app.schemas.trip import LocationUpdate
+from pydantic import ValidationError
+from pymongo import ReturnDocument
 
+from datetime import datetime, timezone
+import asyncio
+import logging
 import time
 
+log = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# location history is append-only: buffer pings from all trips and write
+# them with one insert_many per interval instead of one insert per ping
+LOC_FLUSH_INTERVAL_S = 1.0
+_loc_buffer: list[dict] = []
+_loc_flusher: asyncio.Task | None = None
+
+
+async def _flush_locations():
+    global _loc_buffer
+    if not _loc_buffer:
+        return
+    batch, _loc_buffer = _loc_buffer, []
+    try:
+        await db().locations.insert_many(batch, ordered=False)
+    except Exception:
+        # history is best-effort; drop the batch but leave a trace
+        log.exception("dropped %d location history docs", len(batch))
+
+
+async def _flush_locations_forever():
+    while True:
+        await asyncio.sleep(LOC_FLUSH_INTERVAL_S)
+        await _flush_locations()
+
+
+def start_location_flusher():
+    global _loc_flusher
+    if _loc_flusher is None:
+        _loc_flusher = asyncio.create_task(_flush_locations_forever())
+
+
+async def stop_location_flusher():
+    global _loc_flusher
+    if _loc_flusher is not None:
+        _loc_flusher.cancel()
+        try:
+            await _loc_flusher
+        except asyncio.CancelledError:
+            pass
+        _loc_flusher = None
+    await _flush_locations()
+
+
+# index = (delay > 5) + (delay > 20); early or on-time is green
+_DELAY_COLORS = ("green", "yellow", "red")
+
 
 def compute_delay(planned_eta_ms: int | None, now_ms: int) -> tuple[int | None, str | None]:
     if not planned_eta_ms:
         return None, None
 
-    delay_min = int((now_ms - planned_eta_ms) / 60000)
+    delay_min = (now_ms - planned_eta_ms) // 60000
+    return delay_min, _DELAY_COLORS[(delay_min > 5) + (delay_min > 20)]
 
-    # early or on-time
-    if delay_min <= 5:
-        return delay_min, "green"
-    if delay_min <= 20:
-        return delay_min, "yellow"
-    return delay_min, "red"
+
+async def location_body(request: Request) -> LocationUpdate:
+    # validate straight from the raw bytes in pydantic-core (no json.loads -> dict step)
+    try:
+        return LocationUpdate.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            # no input echo: for JSON errors it's the raw body bytes, which may not decode
+            [
+                {**err, "loc": ("body", *err["loc"])}
+                for err in e.errors(include_url=False, include_input=False)
+            ]
+        )
 
 
 @router.post("/trips/{trip_id}/location")
-async def update_location(trip_id: str, loc: LocationUpdate, user=Depends(require_roles("driver"))):
-    # ensure trip exists
-    trip = await db().trips.find_one({"trip_id": trip_id})
-    if not trip:
+async def update_location(
+    trip_id: str,
+    # auth first: dependencies resolve in declaration order, so 401/403 beat 422
+    user=Depends(require_roles("driver")),
+    loc: LocationUpdate = Depends(location_body),
+):
+    now_ms = time.time_ns() // 1_000_000
+    ts = loc.ts or now_ms
+
+    # ensure trip exists + write the summary fields in one round-trip;
+    # BEFORE gives us the fields needed for delay/status below
+    trip = await db().trips.find_one_and_update(
+        {"trip_id": trip_id},
+        {"$set": {
+            "last_location": {"lat": loc.lat, "lng": loc.lng, "speed": loc.speed, "ts": ts},
+            "last_update_ms": now_ms,
+        }},
+        projection={"_id": 0, "planned_eta_ms": 1, "status": 1, "delay_minutes": 1, "delay_color": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if trip is None:  # {} is a real trip that just lacks the projected fields
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    now_ms = int(time.time() * 1000)
-    ts = loc.ts or now_ms
+    delay_minutes, delay_color = compute_delay(trip.get("planned_eta_ms"), now_ms)
 
-    # save location history
-    await db().locations.insert_one({
+    # location history (time-series: ts must be a BSON date), written by the flusher
+    _loc_buffer.append({
         "trip_id": trip_id,
         "lat": loc.lat,
         "lng": loc.lng,
-        "ts": ts,
+        "ts": datetime.fromtimestamp(ts / 1000, tz=timezone.utc),
         "speed": loc.speed,
         "driver": user["sub"],
     })
 
-    delay_minutes, delay_color = compute_delay(trip.get("planned_eta_ms"), now_ms)
-
-    # update trip summary fields (for public read)
-    update_doc = {
-        "last_location": {"lat": loc.lat, "lng": loc.lng, "speed": loc.speed, "ts": ts},
-        "last_update_ms": now_ms,
-        "delay_minutes": delay_minutes,
-        "delay_color": delay_color,
-    }
+    # delay only moves once a minute -> follow-up $set only when something changed
+    update_doc = {}
+    if delay_minutes != trip.get("delay_minutes") or delay_color != trip.get("delay_color"):
+        update_doc["delay_minutes"] = delay_minutes
+        update_doc["delay_color"] = delay_color
 
     # auto status: scheduled -> in_transit
     if trip.get("status") == "scheduled":
         update_doc["status"] = "in_transit"
 
-    await db().trips.update_one({"trip_id": trip_id}, {"$set": update_doc})
-
-    # broadcast to websocket subscribers
-    payload = {
-        "trip_id": trip_id,
-        "lat": loc.lat,
-        "lng": loc.lng,
-        "speed": loc.speed,
-        "ts": ts,
-        "delay_minutes": delay_minutes,
-        "delay_color": delay_color,
-    }
-    await manager.broadcast(trip_id, payload)
+    if update_doc:
+        await db().trips.update_one({"trip_id": trip_id}, {"$set": update_doc})
+
+    # broadcast to websocket subscribers (fixed-shape -> binary frame)
+    await manager.broadcast_location(
+        trip_id,
+        loc.lat,
+        loc.lng,
+        loc.speed,
+        ts,
+        delay_minutes,
+        _DELAY_COLORS.index(delay_color) if delay_color else None,
+    )
 
     return {"ok": True}
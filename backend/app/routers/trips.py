@@ -1,22 +1,65 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import ORJSONResponse, Response
 from app.auth.deps import require_roles
-from app.db.mongo import db
+from app.db.mongo import LIVE_SHARE, db
 from app.schemas.trip import TripCreate, TripPatch
+from pymongo.errors import DuplicateKeyError
 
+from collections import deque
+import orjson
+from datetime import datetime, timezone
+import os
 import time
-import secrets
 
 router = APIRouter()
 
+# what the owner trips table renders
+_TRIP_LIST_FIELDS = {
+    "_id": 0,
+    "trip_id": 1,
+    "truck_id": 1,
+    "customer_id": 1,
+    "driver_id": 1,
+    "status": 1,
+    "planned_eta_ms": 1,
+    "last_location": 1,
+    "delay_minutes": 1,
+    "delay_color": 1,
+    "created_at_ms": 1,
+    "updated_at": 1,
+    "updated_at_ms": 1,  # trips written before updated_at was server-stamped
+}
+
+# what the public tracking pages read
+_PUBLIC_TRIP_FIELDS = (
+    "trip_id",
+    "status",
+    "planned_eta_ms",
+    "customer_id",
+    "driver_id",
+    "truck_id",
+    "last_location",
+    "last_update_ms",
+    "delay_minutes",
+    "delay_color",
+)
+_PUBLIC_TRIP_PROJECTION = {"_id": 0, **{k: 1 for k in _PUBLIC_TRIP_FIELDS}}
+
 
 @router.post("/trips")
 async def create_trip(payload: TripCreate, user=Depends(require_roles("owner"))):
-    doc = payload.model_dump()
-    doc["updated_at_ms"] = int(time.time() * 1000)
+    doc = payload.model_dump(exclude_unset=True)
+
+    # defaults (e.g. status) only on first insert, so re-posting a trip
+    # doesn't reset fields the owner didn't send; Mongo stamps updated_at
+    update = {"$set": doc, "$currentDate": {"updated_at": True}}
+    defaults = payload.model_dump(exclude=payload.model_fields_set)
+    if defaults:
+        update["$setOnInsert"] = defaults
 
     await db().trips.update_one(
         {"trip_id": payload.trip_id},
-        {"$set": doc},
+        update,
         upsert=True,
     )
     return {"ok": True, "trip_id": payload.trip_id}
@@ -24,19 +67,24 @@ async def create_trip(payload: TripCreate, user=Depends(require_roles("owner")))
 
 @router.get("/trips")
 async def list_trips(user=Depends(require_roles("owner"))):
-    trips = await db().trips.find({}, {"_id": 0}).to_list(length=200)
-    return trips
+    cursor = db().trips.find({}, _TRIP_LIST_FIELDS).limit(200)
+    # collected before responding, so a Mongo error is a 500, not a cut-off 200
+    trips = [t async for t in cursor]
+    # one encode for the whole array; Mongo dates come back naive UTC
+    body = orjson.dumps(trips, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+    return Response(body, media_type="application/json")
 
 
 @router.patch("/trips/{trip_id}")
 async def patch_trip(trip_id: str, patch: TripPatch, user=Depends(require_roles("owner"))):
-    update = {k: v for k, v in patch.model_dump().items() if v is not None}
+    update = patch.model_dump(exclude_none=True)
     if not update:
         return {"ok": True}
 
-    update["updated_at_ms"] = int(time.time() * 1000)
-
-    res = await db().trips.update_one({"trip_id": trip_id}, {"$set": update})
+    res = await db().trips.update_one(
+        {"trip_id": trip_id},
+        {"$set": update, "$currentDate": {"updated_at": True}},
+    )
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Trip not found")
 
@@ -46,53 +94,77 @@ async def patch_trip(trip_id: str, patch: TripPatch, user=Depends(require_roles(
 # -------------------------
 # OTP share link (MVP)
 # -------------------------
+_otp_pool: deque[str] = deque()
+
+
+def _next_otp() -> str:
+    # one urandom read per ~240 codes; 20-bit draws, rejecting >= 10**6 keeps them uniform
+    while not _otp_pool:
+        raw = os.urandom(3 * 256)
+        for i in range(0, len(raw), 3):
+            n = int.from_bytes(raw[i:i + 3], "little") & 0xFFFFF
+            if n < 1000000:
+                _otp_pool.append(f"{n:06d}")
+    return _otp_pool.popleft()
+
+
 @router.post("/trips/{trip_id}/share-otp")
 async def create_share_otp(trip_id: str, user=Depends(require_roles("owner"))):
-    trip = await db().trips.find_one({"trip_id": trip_id}, {"_id": 0})
+    # existence only; answered from the trip_id index without a FETCH
+    trip = await db().trips.find_one({"trip_id": trip_id}, {"_id": 0, "trip_id": 1})
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    otp = f"{secrets.randbelow(1000000):06d}"
-    now_ms = int(time.time() * 1000)
+    now_ms = time.time_ns() // 1_000_000
     expires_ms = now_ms + (15 * 60 * 1000)
-
-    await db().trip_shares.update_one(
-        {"trip_id": trip_id},
-        {"$set": {"trip_id": trip_id, "otp": otp, "expires_ms": expires_ms, "created_at_ms": now_ms}},
-        upsert=True,
-    )
+    expires_at = datetime.fromtimestamp(expires_ms / 1000, tz=timezone.utc)
+
+    # otp is unique-indexed; retry on the rare clash with another trip's code
+    for _ in range(5):
+        otp = _next_otp()
+        try:
+            await db().trip_shares.update_one(
+                {"trip_id": trip_id},
+                {"$set": {
+                    "trip_id": trip_id,
+                    "otp": otp,
+                    "expires_ms": expires_ms,
+                    "expires_at": expires_at,
+                    "created_at_ms": now_ms,
+                }},
+                upsert=True,
+            )
+            break
+        except DuplicateKeyError:
+            continue
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate OTP, retry")
 
     return {"ok": True, "otp": otp, "expires_ms": expires_ms}
 
 
 @router.get("/public/resolve-otp")
 async def resolve_otp(otp: str):
-    now_ms = int(time.time() * 1000)
-    share = await db().trip_shares.find_one({"otp": otp}, {"_id": 0})
+    now_ms = time.time_ns() // 1_000_000
+    # legacy share docs (no expires_at) are all long expired and may reuse codes;
+    # matching LIVE_SHARE also lets the partial covered index serve this
+    share = await db().trip_shares.find_one(
+        {"otp": otp, **LIVE_SHARE}, {"_id": 0, "trip_id": 1, "expires_ms": 1}
+    )
     if not share:
         raise HTTPException(status_code=404, detail="Invalid OTP")
 
     if share["expires_ms"] < now_ms:
         raise HTTPException(status_code=410, detail="OTP expired")
 
-    return {"trip_id": share["trip_id"], "expires_ms": share["expires_ms"]}
+    return ORJSONResponse({"trip_id": share["trip_id"], "expires_ms": share["expires_ms"]})
 
 
 @router.get("/public/trips/{trip_id}")
 async def public_trip(trip_id: str):
-    trip = await db().trips.find_one({"trip_id": trip_id}, {"_id": 0})
+    trip = await db().trips.find_one({"trip_id": trip_id}, _PUBLIC_TRIP_PROJECTION)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    return {
-        "trip_id": trip.get("trip_id"),
-        "status": trip.get("status"),
-        "planned_eta_ms": trip.get("planned_eta_ms"),
-        "customer_id": trip.get("customer_id"),
-        "driver_id": trip.get("driver_id"),
-        "truck_id": trip.get("truck_id"),
-        "last_location": trip.get("last_location"),
-        "last_update_ms": trip.get("last_update_ms"),
-        "delay_minutes": trip.get("delay_minutes"),
-        "delay_color": trip.get("delay_color"),
-    }
+    # fixed shape (missing fields -> null); plain values, so skip jsonable_encoder
+    return ORJSONResponse({k: trip.get(k) for k in _PUBLIC_TRIP_FIELDS})
@@ -1,8 +1,5 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, WebSocket
 from app.realtime.manager import manager
-from app.routers import ws
-
-
 
 router = APIRouter()
 
@@ -11,7 +8,10 @@ async def trip_ws(ws: WebSocket, trip_id: str):
     await manager.connect(trip_id, ws)
     try:
         while True:
-            # keep connection alive; client can send pings
-            await ws.receive_text()
-    except WebSocketDisconnect:
+            # keep connection alive; client pings are read raw (no text decode)
+            # and only the disconnect message matters
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+    finally:
         manager.disconnect(trip_id, ws)
@@ -1,25 +1,28 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, Literal
 
 TripStatus = Literal["scheduled", "in_transit", "delayed", "delivered", "cancelled"]
 
+# epoch ms up to 9999-12-31T23:59:59.999Z, the last instant datetime can hold
+MAX_EPOCH_MS = 253402300799999
+
 
 class TripCreate(BaseModel):
     trip_id: str
     customer_id: str
     driver_id: str
     truck_id: Optional[str] = None
-    planned_eta_ms: Optional[int] = None
+    planned_eta_ms: Optional[int] = Field(default=None, ge=0, le=MAX_EPOCH_MS)
     status: TripStatus = "scheduled"
 
 
 class TripPatch(BaseModel):
     status: Optional[TripStatus] = None
-    planned_eta_ms: Optional[int] = None
+    planned_eta_ms: Optional[int] = Field(default=None, ge=0, le=MAX_EPOCH_MS)
 
 
 class LocationUpdate(BaseModel):
     lat: float
     lng: float
-    ts: Optional[int] = None
+    ts: Optional[int] = Field(default=None, ge=0, le=MAX_EPOCH_MS)
     speed: Optional[float] = None
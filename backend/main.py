@@ -9,24 +9,27 @@ FRONTEND_DIR = REPO_DIR / "frontend"                # .../WindsorLogistics/front
 # Load env from backend/.env (matches your folder structure)
 load_dotenv(BASE_DIR / ".env")
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
+from app.db.mongo import db, ensure_collections, ensure_indexes
+from app.realtime.manager import manager
 from app.routers import auth, trips, trucks, tracking, ws
 
 
 def create_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
 
     # CORS (MVP ok; tighten later)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
         allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
+        # explicit lists: preflights skip the wildcard echo path
+        allow_methods=["GET", "POST", "PATCH", "OPTIONS"],
+        allow_headers=["content-type", "authorization"],
     )
 
     # Static mount (serves /static/track.html, /static/owner_trips.html, etc.)
@@ -43,20 +46,44 @@ def create_app() -> FastAPI:
     app.include_router(tracking.router, prefix="/api")
     app.include_router(ws.router)  # websocket routes already have full paths
 
+    @app.on_event("startup")
+    async def startup():
+        # create the client/database handle once, before the first request
+        db()
+        await ensure_collections()
+        await ensure_indexes()
+        await manager.start()
+        tracking.start_location_flusher()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await tracking.stop_location_flusher()
+        await manager.stop()
+
     # Pages / health
     @app.get("/")
-    def root():
+    async def root():
         # Better demo: open the owner page by default
         return RedirectResponse(url="/static/owner_trips.html")
 
     @app.get("/health")
-    def health():
+    async def health():
         return {"ok": True}
 
-    # Optional direct route (not required since /static already serves it)
+    # Optional direct route (not required since /static already serves it);
+    # read once, then served from memory with an mtime ETag
+    html_cache = {}
+    for name in ("owner_trips.html",):
+        path = FRONTEND_DIR / name
+        html_cache[name] = (path.read_bytes(), f'W/"{path.stat().st_mtime_ns:x}"')
+
     @app.get("/owner_trips.html")
-    def owner_trips_page():
-        return FileResponse(FRONTEND_DIR / "owner_trips.html")
+    async def owner_trips_page(request: Request):
+        body, etag = html_cache["owner_trips.html"]
+        headers = {"etag": etag, "cache-control": "public, max-age=60"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="text/html", headers=headers)
 
     return app
 